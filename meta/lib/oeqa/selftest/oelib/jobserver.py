@@ -0,0 +1,114 @@
+import unittest
+import os
+import fcntl
+import threading
+import time
+import shutil
+import tempfile
+from oeqa.utils.jobserver import JobServer
+
+class TestJobServer(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='oeqa-jobserver-')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_no_jobserver(self):
+        js = JobServer('-j4')
+        self.assertFalse(js.enabled)
+        with js.token():
+            pass
+
+    def test_fds_not_a_pipe(self):
+        """
+        Descriptors that don't refer to a pipe must not be used as jobserver
+        """
+        path = os.path.join(self.tempdir, 'log')
+        with open(path, 'w') as f:
+            f.write('vvvv')
+        rfd = os.open(path, os.O_RDONLY)
+        wfd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        try:
+            js = JobServer('--jobserver-auth=%d,%d' % (rfd, wfd))
+            self.assertFalse(js.enabled)
+            with js.token():
+                pass
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'vvvv')
+
+    def test_fds_pipe(self):
+        rfd, wfd = os.pipe()
+        try:
+            os.write(wfd, b'+')
+            js = JobServer('--jobserver-auth=%d,%d' % (rfd, wfd))
+            self.assertTrue(js.enabled)
+            token = js.acquire()
+            self.assertEqual(token, b'+')
+            js.release(token)
+            self.assertEqual(os.read(rfd, 1), b'+')
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    def test_fds_pipe_nonblocking(self):
+        """
+        A non-blocking jobserver pipe (make >= 4.3) must wait for a token
+        """
+        rfd, wfd = os.pipe()
+        try:
+            flags = fcntl.fcntl(rfd, fcntl.F_GETFL)
+            fcntl.fcntl(rfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            js = JobServer('--jobserver-auth=%d,%d' % (rfd, wfd))
+            self.assertTrue(js.enabled)
+            writer = threading.Timer(0.2, os.write, (wfd, b'+'))
+            writer.start()
+            start = time.time()
+            token = js.acquire()
+            writer.join()
+            self.assertEqual(token, b'+')
+            self.assertGreaterEqual(time.time() - start, 0.1)
+            js.release(token)
+            self.assertEqual(os.read(rfd, 1), b'+')
+        finally:
+            os.close(rfd)
+            os.close(wfd)
+
+    def test_fifo(self):
+        fifo = os.path.join(self.tempdir, 'fifo')
+        os.mkfifo(fifo)
+        fd = os.open(fifo, os.O_RDWR)
+        try:
+            os.write(fd, b'++')
+            js = JobServer('-j3 --jobserver-auth=fifo:%s' % fifo)
+            self.assertTrue(js.enabled)
+            with js.token():
+                with js.token():
+                    pass
+            js.close()
+            # Both tokens have been returned
+            self.assertEqual(os.read(fd, 2), b'++')
+        finally:
+            os.close(fd)
+
+    def test_fifo_not_a_fifo(self):
+        path = os.path.join(self.tempdir, 'notfifo')
+        open(path, 'w').close()
+        js = JobServer('--jobserver-auth=fifo:%s' % path)
+        self.assertFalse(js.enabled)
+
+    def test_jobserver_gone(self):
+        rfd, wfd = os.pipe()
+        os.close(wfd)
+        r2, w2 = os.pipe()
+        try:
+            js = JobServer('--jobserver-auth=%d,%d' % (rfd, w2))
+            self.assertTrue(js.enabled)
+            self.assertIsNone(js.acquire())
+        finally:
+            os.close(rfd)
+            os.close(r2)
+            os.close(w2)
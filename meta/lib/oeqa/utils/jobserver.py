@@ -0,0 +1,94 @@
+# Minimal client for the GNU make jobserver, so tests that start heavy
+# processes (e.g. qemu) can share the job slots of an outer make/bitbake
+# instead of oversubscribing the host.
+
+import os
+import re
+import stat
+import select
+import contextlib
+
+class JobServer(object):
+    def __init__(self, makeflags=None):
+        if makeflags is None:
+            makeflags = os.environ.get('MAKEFLAGS', '')
+        self.rfd = None
+        self.wfd = None
+        self._fifo = False
+
+        # Only the last option counts, as make appends its own at the end
+        auth = re.findall(r'--jobserver-(?:auth|fds)=(\S+)', makeflags)
+        if not auth:
+            return
+        auth = auth[-1]
+        try:
+            if auth.startswith('fifo:'):
+                fd = os.open(auth[len('fifo:'):], os.O_RDWR)
+                if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+                    os.close(fd)
+                    return
+                self.rfd = self.wfd = fd
+                self._fifo = True
+            else:
+                rfd, wfd = (int(fd) for fd in auth.split(','))
+                # make marks the pipe close-on-exec for non-recursive
+                # commands but still exports the numbers, which may then
+                # belong to unrelated files, so only accept a pipe
+                if stat.S_ISFIFO(os.fstat(rfd).st_mode) and \
+                        stat.S_ISFIFO(os.fstat(wfd).st_mode):
+                    self.rfd, self.wfd = rfd, wfd
+        except (OSError, ValueError):
+            self.rfd = self.wfd = None
+
+    @property
+    def enabled(self):
+        return self.rfd is not None
+
+    def acquire(self):
+        """
+            Blocks until a token is available and returns it,
+            None if there is no jobserver.
+        """
+        if not self.enabled:
+            return None
+        while True:
+            try:
+                # An empty read means the jobserver is gone
+                return os.read(self.rfd, 1) or None
+            except BlockingIOError:
+                # make >= 4.3 sets the read end non-blocking
+                select.select([self.rfd], [], [])
+            except InterruptedError:
+                continue
+
+    def release(self, token):
+        if not self.enabled or token is None:
+            return
+        os.write(self.wfd, token)
+
+    @contextlib.contextmanager
+    def token(self):
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def close(self):
+        if self._fifo and self.rfd is not None:
+            os.close(self.rfd)
+        self.rfd = self.wfd = None
+
+# Check the inherited descriptors at import time, before the tests can open
+# files that reuse the numbers of descriptors make has closed
+_jobserver = JobServer()
+
+def get_jobserver():
+    return _jobserver
+
+def token():
+    """
+        Context manager holding one jobserver token while active. It is a
+        no-op when not running under a jobserver.
+    """
+    return get_jobserver().token()